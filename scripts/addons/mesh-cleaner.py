@@ -13,70 +13,467 @@ import os
 import sys
 import json
 import time
+import shutil
+import argparse
+import tempfile
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-import bpy
-from bpy.types import Panel
-from mathutils import kdtree
-
-
-class PointCloudCleaningOperator(bpy.types.Operator):
-    bl_idname = "object.pc_clean"
-    bl_label = "Clean point cloud"
-    bl_options = {"REGISTER", "UNDO"}
-
-    distance = bpy.props.FloatProperty(name="Max distance", default=0.1, min=0, max=1000)
-    neighbors = bpy.props.IntProperty(name="Min neighbor count", default=10, min=0, max=1000)
-    recursion = bpy.props.IntProperty(name="Iterations", default=1, min=1, max=10)
-
-    def invoke(self, context, event):
-        wm = context.window_manager
-        return wm.invoke_props_dialog(self)
-
-    def execute(self, context):
-        obj = context.selected_objects[0]
-        for _ in range(self.recursion):
-            verts = bpy.context.selected_objects[0].data.vertices #[0].co
-            bpy.ops.object.mode_set(mode="EDIT")
-            bpy.ops.mesh.select_all(action='DESELECT')
-            bpy.ops.object.mode_set(mode="OBJECT")
-            tree = kdtree.KDTree(len(verts))
-            for i, v in enumerate(verts):
-                tree.insert(v.co, i)
-            tree.balance()
-            for idx, vert in enumerate(verts):
-                r = tree.find_range(vert.co, self.distance)
-                if len(r) < self.neighbors:
-                    verts[idx].select = True
-
-            bpy.ops.object.mode_set(mode = 'EDIT')
-            bpy.ops.mesh.delete(type='VERT')
-            bpy.ops.object.mode_set(mode = 'OBJECT')
-        return {'FINISHED'}
-
-
-class VIEW3D_PT_tools_Meshify(Panel):
-    bl_category = "Tools"
-    bl_context = "objectmode"
-    bl_label = "Point cloud"
-    bl_idname = "OBJECT_OT_pc_clean"
-    bl_space_type = 'VIEW_3D'
-    bl_region_type = 'TOOLS'
-
-    def draw(self, context):
-        layout = self.layout
-        obj = context.object
-        layout.row().operator("object.pc_clean", emboss=True)
-
-def register():
-    bpy.utils.register_class(PointCloudCleaningOperator)
-    bpy.utils.register_class(VIEW3D_PT_tools_Meshify)
-
-def unregister():
-    bpy.utils.unregister_class(VIEW3D_PT_tools_Meshify)
-    bpy.utils.unregister_class(PointCloudCleaningOperator)
+import numpy as np
+try:
+    from scipy.spatial import cKDTree
+except ImportError: # not bundled with blender, mathutils is used instead
+    cKDTree = None
+
+try:
+    import bpy
+    import bmesh
+    from bpy.types import Panel
+    from mathutils import kdtree
+except ImportError: # plain python, only the files cleaning is available
+    bpy = None
+
+PLY_TYPES = {'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2', 'int': 'i4', 'uint': 'u4',
+        'float': 'f4', 'double': 'f8', 'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+        'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8'}
+POINT_BYTES = 128 # memory used by each point of a tile being cleaned
+
+
+class PointIndex:
+    " Range queries on (N, 3) points, using scipy if available, else mathutils "
+    def __init__(self, coords):
+        if cKDTree is not None:
+            self.tree = cKDTree(coords)
+        else:
+            self.tree = kdtree.KDTree(len(coords))
+            for i, co in enumerate(coords):
+                self.tree.insert(co, i)
+            self.tree.balance()
+
+    def counts(self, coords, distance):
+        " Returns the number of indexed points within `distance` of each of `coords` "
+        if cKDTree is not None:
+            return self.tree.query_ball_point(coords, distance, return_length=True)
+        return np.array([len(self.tree.find_range(co, distance)) for co in coords], dtype=np.int64)
+
+    def neighbors(self, coords, distance):
+        " Returns the indices of the points within `distance` of any of `coords`, once per query point "
+        if cKDTree is not None:
+            found = self.tree.query_ball_point(coords, distance)
+        else:
+            found = ([i for co, i, dist in self.tree.find_range(co, distance)] for co in coords)
+        return np.fromiter(itertools.chain.from_iterable(found), dtype=np.int64)
+
+    def nearest_distances(self, coords, k):
+        " Returns the distances from each of `coords` to its `k` nearest indexed points, nearest first "
+        if cKDTree is not None:
+            return self.tree.query(coords, k)[0].reshape(len(coords), k)
+        return np.array([[dist for co, i, dist in self.tree.find_n(co, k)] for co in coords]).reshape(len(coords), k)
+
+def pool_map(function, workers, *iterables):
+    """ Same as map(), using `workers` processes if more than one
+
+    Results are still returned in order, only a few calls per worker are
+    submitted ahead so that lazy `iterables` are only read as needed.
+    """
+    if workers <= 1:
+        yield from map(function, *iterables)
+        return
+    pool = ProcessPoolExecutor(workers)
+    pending = deque()
+    try:
+        for args in zip(*iterables):
+            pending.append(pool.submit(function, *args))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+def _slab_counts(coords, first, last, distance):
+    " Neighbor counts of the core points `first` to `last` of a slab, see `neighbor_counts` "
+    return PointIndex(coords).counts(coords[first:last], distance)
+
+def neighbor_counts(coords, distance, workers=1):
+    """ Returns the number of points within `distance` of each point, itself included
+
+    With several `workers`, the cloud is cut into slabs along its longest axis
+    which are counted in parallel, each one along with the points closer than
+    `distance` around it, so that the counts are the same. Points are sorted
+    along that axis once, so every slab is a range of the sorted points, only
+    copied when it is sent to a worker.
+    """
+    if workers <= 1 or len(coords) < 2:
+        return PointIndex(coords).counts(coords, distance)
+    axis = np.argmax(coords.max(axis=0) - coords.min(axis=0))
+    order = np.argsort(coords[:, axis], kind='mergesort')
+    x = coords[order, axis]
+    cuts = x[np.linspace(0, len(x), 4 * workers + 1)[1:-1].astype(np.int64)]
+    edges = np.concatenate(([-np.inf], np.unique(cuts), [np.inf]))
+    halo = distance * (1 + 1e-6)
+
+    cores = np.searchsorted(x, edges) # core of slab i: cores[i] to cores[i+1]
+    starts = np.searchsorted(x, edges[:-1] - halo)
+    ends = np.searchsorted(x, edges[1:] + halo, side='right')
+    args = ((coords[order[start:end]] for start, end in zip(starts, ends)),
+            cores[:-1] - starts, cores[1:] - starts, itertools.repeat(distance))
+    counts = np.zeros(len(coords), dtype=np.int64)
+    for first, last, slab_counts in zip(cores[:-1], cores[1:], pool_map(_slab_counts, workers, *args)):
+        counts[order[first:last]] = slab_counts
+    return counts
+
+def outliers_mask(coords, distance, neighbors, iterations=1, workers=1):
+    """ Returns the mask of the points having less than `neighbors` points within `distance`
+
+    Each iteration only counts the points left by the previous one. Points are
+    counted once (in `workers` processes, see `neighbor_counts`), then only the
+    neighbours of the points removed by an iteration have their count updated,
+    until no more points are removed.
+    """
+    counts = neighbor_counts(coords, distance, workers)
+    removed = counts < neighbors
+    fresh = removed.copy()
+    index = None
+    for _ in range(iterations - 1):
+        if not fresh.any():
+            break
+        if index is None:
+            index = PointIndex(coords)
+        counts -= np.bincount(index.neighbors(coords[fresh], distance), minlength=len(coords))
+        fresh = ~removed & (counts < neighbors)
+        removed |= fresh
+    return removed
+
+def statistical_outliers(coords, k, std_ratio):
+    """ Returns the mask of the points far from their neighbours, and the distance used
+
+    The mean distance of every point to its `k` nearest neighbours is computed,
+    points for which it exceeds the mean of all of them by more than
+    `std_ratio` standard deviations are outliers, whatever the scale of the cloud.
+    """
+    if len(coords) <= k:
+        return np.zeros(len(coords), dtype=bool), 0.
+    mean_dist = PointIndex(coords).nearest_distances(coords, k+1)[:, 1:].mean(axis=1) # without itself
+    limit = mean_dist.mean() + std_ratio * mean_dist.std()
+    return mean_dist > limit, limit
+
+def voxel_groups(coords, size):
+    " Returns the voxel number of each point of a grid of `size`, voxels being numbered in sorted order "
+    if not len(coords):
+        return np.empty(0, dtype=np.int64)
+    cells = np.floor(coords / size).astype(np.int64)
+    cells -= cells.min(axis=0)
+    dims = cells.max(axis=0) + 1
+    if np.prod(dims.astype(np.float64)) < 2**62: # one key per voxel, sorted as a single column
+        return np.unique(np.ravel_multi_index(cells.T, dims), return_inverse=True)[1]
+    return np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+
+def voxel_downsample(coords, size):
+    """ Groups the points by voxels of a grid of `size`
+
+    Returns, for each occupied voxel, the index of its point closest to the
+    centroid and the centroid of its points.
+    """
+    if not len(coords):
+        return np.empty(0, dtype=np.int64), np.empty((0, 3))
+    voxels = voxel_groups(coords, size)
+    counts = np.bincount(voxels)
+    centroids = np.column_stack([np.bincount(voxels, weights=coords[:, axis]) / counts for axis in range(3)])
+    dist = ((coords - centroids[voxels]) ** 2).sum(axis=1)
+    order = np.lexsort((dist, voxels))
+    firsts = np.concatenate(([0], np.cumsum(counts)[:-1])) # each voxel is a run of `order`
+    return order[firsts], centroids
+
+class PlyCloud:
+    " Vertices of a binary PLY file, read from a memory map "
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.readline().strip() != b'ply':
+                raise ValueError("%s isn't a PLY file"%filename)
+            lines = []
+            for line in f:
+                line = line.decode('ascii').strip()
+                if line == 'end_header':
+                    break
+                lines.append(line)
+            self.offset = f.tell()
+
+        self.header = [line for line in lines if line.split()[0] in ('format', 'comment', 'obj_info')]
+        fmt = self.header[0].split()[1] if self.header and self.header[0].startswith('format') else None
+        if fmt not in ('binary_little_endian', 'binary_big_endian'):
+            raise ValueError("%s: only binary PLY files are supported"%filename)
+        elements = [line for line in lines if line.startswith('element')]
+        if not elements or elements[0].split()[1] != 'vertex':
+            raise ValueError("%s: the vertices must be the first element"%filename)
+        self.count = int(elements[0].split()[2])
+        # properties of the vertex element
+        first = lines.index(elements[0]) + 1
+        last = lines.index(elements[1]) if len(elements) > 1 else len(lines)
+        self.properties = [line for line in lines[first:last] if line.startswith('property')]
+        order = '<' if fmt == 'binary_little_endian' else '>'
+        if any(prop.split()[1] == 'list' for prop in self.properties):
+            raise ValueError("%s: list properties of vertices aren't supported"%filename)
+        self.dtype = np.dtype([(prop.split()[2], order + PLY_TYPES[prop.split()[1]]) for prop in self.properties])
+
+    def chunks(self, size):
+        " Yields the (N, 3) coordinates and the records of the vertices, `size` at a time "
+        if not self.count:
+            return
+        data = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=(self.count,))
+        for start in range(0, self.count, size):
+            records = data[start:start+size]
+            yield np.column_stack([records[axis] for axis in 'xyz']).astype(np.float64), records
+
+    def write(self, filename, chunks, count):
+        " Writes the `count` vertex records of `chunks` as a PLY file of the same format "
+        header = ['ply'] + self.header + ['element vertex %d'%count] + self.properties + ['end_header']
+        with open(filename, 'wb') as f:
+            f.write(('\n'.join(header) + '\n').encode('ascii'))
+            for records in chunks:
+                f.write(records.tobytes())
+
+class XyzCloud:
+    " Points of a text file, one `x y z [...]` line each "
+    def __init__(self, filename):
+        self.filename = filename
+
+    def chunks(self, size):
+        " Yields the (N, 3) coordinates and the lines of the points, `size` at a time "
+        with open(self.filename) as f:
+            while True:
+                lines = list(itertools.islice(f, size))
+                if not lines:
+                    break
+                lines = np.array([line for line in lines if line.strip()], dtype=object)
+                if len(lines):
+                    yield np.array([line.replace(',', ' ').split()[:3] for line in lines], dtype=np.float64), lines
+
+    def write(self, filename, chunks, count):
+        with open(filename, 'w') as f:
+            for lines in chunks:
+                f.writelines(lines)
+
+def open_cloud(filename):
+    if filename.lower().endswith('.ply'):
+        return PlyCloud(filename)
+    return XyzCloud(filename)
+
+def clean_file(source, target, distance, neighbors, iterations=1, memory=1024, tmpdir=None, workers=1):
+    """ Removes the outliers of a point cloud file (see `outliers_mask`), writes the other points to `target`
+
+    The cloud is cut into slabs along its longest axis, each one is cleaned
+    along with a halo of `iterations` times `distance` on both sides, which the
+    removals can't reach through, so the result is the same as for the whole
+    cloud at once. Slabs are sized so that cleaning one takes about `memory` MB,
+    one more byte per point is used to flag the removed ones.
+    Returns the number of points read and removed.
+    """
+    cloud = open_cloud(source)
+    budget = max(1000, memory * 2**20 // POINT_BYTES) # points processed at a time
+
+    count = 0
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for coords, records in cloud.chunks(budget):
+        count += len(coords)
+        low = np.minimum(low, coords.min(axis=0))
+        high = np.maximum(high, coords.max(axis=0))
+    if not count:
+        cloud.write(target, [], 0)
+        return 0, 0
+
+    # slabs holding half the budget, leaving room for their halo
+    axis = np.argmax(high - low)
+    if high[axis] > low[axis]:
+        bins = 65536
+        histogram = np.zeros(bins, dtype=np.int64)
+        for coords, records in cloud.chunks(budget):
+            histogram += np.histogram(coords[:, axis], bins, (low[axis], high[axis]))[0]
+        slabs = int(np.ceil(count / (budget / 2.)))
+        cuts = np.searchsorted(np.cumsum(histogram), np.arange(1, slabs) * count / slabs)
+        edges = np.unique(np.concatenate(([low[axis]], low[axis] + (high[axis] - low[axis]) * (cuts + 1) / bins, [high[axis]])))
+    else: # every point at the same place, it can't be cut
+        edges = low[axis:axis+1].repeat(2)
+    edges[-1] = np.inf # the last slab includes the highest points
+    halo = iterations * distance * (1 + 1e-6)
+
+    # copy the coordinates and indices of the points of each slab and its halo
+    folder = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        files = [open(os.path.join(folder, '%d.bin'%n), 'wb') for n in range(len(edges) - 1)]
+        start = 0
+        for coords, records in cloud.chunks(budget):
+            rows = np.column_stack((coords, np.arange(start, start + len(coords))))
+            for f, lo, hi in zip(files, edges[:-1], edges[1:]):
+                f.write(rows[(coords[:, axis] >= lo - halo) & (coords[:, axis] <= hi + halo)].tobytes())
+            start += len(coords)
+        for f in files:
+            f.close()
+
+        removed = np.zeros(count, dtype=bool)
+        for n, (f, lo, hi) in enumerate(zip(files, edges[:-1], edges[1:])):
+            rows = np.fromfile(f.name).reshape(-1, 4)
+            os.remove(f.name)
+            print("Slab %d/%d: %d points"%(n+1, len(files), len(rows)))
+            if not len(rows):
+                continue
+            core = (rows[:, axis] >= lo) & (rows[:, axis] < hi)
+            outliers = outliers_mask(np.ascontiguousarray(rows[:, :3]), distance, neighbors, iterations, workers)
+            removed[rows[core & outliers, 3].astype(np.int64)] = True
+    finally:
+        shutil.rmtree(folder)
+
+    def kept():
+        start = 0
+        for coords, records in cloud.chunks(budget):
+            yield records[~removed[start:start+len(records)]]
+            start += len(records)
+    cloud.write(target, kept(), count - int(removed.sum()))
+    return count, int(removed.sum())
+
+def batch_main(args):
+    """ Cleans a point cloud file
+
+    Use `python mesh-cleaner.py [options] input output`
+    or `blender --background --python mesh-cleaner.py -- [options] input output`.
+    """
+    parser = argparse.ArgumentParser(description="Removes the isolated points of a binary PLY or XYZ point cloud")
+    parser.add_argument('input')
+    parser.add_argument('output', help="cleaned file, of the same format")
+    parser.add_argument('--distance', type=float, default=0.1, help="max distance")
+    parser.add_argument('--neighbors', type=int, default=10, help="min neighbor count, the point itself included")
+    parser.add_argument('--iterations', type=int, default=1)
+    parser.add_argument('--memory', type=int, default=1024, help="memory budget in MB")
+    parser.add_argument('--tmpdir', help="folder of the temporary slab files")
+    parser.add_argument('--workers', type=int, default=1, help="processes counting the neighbors")
+    options = parser.parse_args(args)
+
+    t = time.time()
+    count, removed = clean_file(options.input, options.output, options.distance, options.neighbors,
+            options.iterations, options.memory, options.tmpdir, options.workers)
+    print("%s: %d points removed, %d left in %.1fs"%(options.output, removed, count - removed, time.time() - t))
+    return 0
+
+
+if bpy is not None:
+    def mesh_coords(mesh):
+        " Returns the vertices coordinates of a mesh as a (N, 3) array "
+        coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', coords)
+        return coords.reshape(-1, 3)
+
+    def delete_vertices(mesh, mask):
+        " Deletes the vertices of `mesh` flagged in `mask`, along with their edges and faces "
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+        bm.verts.ensure_lookup_table()
+        bmesh.ops.delete(bm, geom=[bm.verts[i] for i in np.flatnonzero(mask)], context=1) # DEL_VERTS
+        bm.to_mesh(mesh)
+        bm.free()
+        mesh.update()
+
+
+    class PointCloudCleaningOperator(bpy.types.Operator):
+        bl_idname = "object.pc_clean"
+        bl_label = "Clean point cloud"
+        bl_options = {"REGISTER", "UNDO"}
+
+        mode = bpy.props.EnumProperty(name="Mode", default='RADIUS', items=(
+                ('RADIUS', "Radius", "Remove the points with too few neighbors within a distance"),
+                ('STATISTICAL', "Statistical", "Remove the points far from their nearest neighbors compared to the others"),
+                ))
+        distance = bpy.props.FloatProperty(name="Max distance", default=0.1, min=0, max=1000)
+        neighbors = bpy.props.IntProperty(name="Min neighbor count", default=10, min=0, max=1000)
+        recursion = bpy.props.IntProperty(name="Iterations", default=1, min=1, max=10)
+        workers = bpy.props.IntProperty(name="Workers", default=1, min=1, max=64)
+        knn = bpy.props.IntProperty(name="Nearest neighbors", default=8, min=1, max=100)
+        std_ratio = bpy.props.FloatProperty(name="Standard deviations", default=2, min=0, max=10)
+
+        def invoke(self, context, event):
+            wm = context.window_manager
+            return wm.invoke_props_dialog(self)
+
+        def draw(self, context):
+            layout = self.layout
+            layout.prop(self, "mode")
+            names = ("distance", "neighbors", "recursion", "workers") if self.mode == 'RADIUS' else ("knn", "std_ratio")
+            for name in names:
+                layout.prop(self, name)
+
+        def execute(self, context):
+            mesh = context.selected_objects[0].data
+            if self.mode == 'RADIUS':
+                removed = outliers_mask(mesh_coords(mesh), self.distance, self.neighbors, self.recursion, self.workers)
+                info = ""
+            else:
+                removed, radius = statistical_outliers(mesh_coords(mesh), self.knn, self.std_ratio)
+                info = ", effective radius %g"%radius
+            delete_vertices(mesh, removed)
+            self.report({'INFO'}, "%d points removed, %d left%s"%(removed.sum(), len(removed) - removed.sum(), info))
+            return {'FINISHED'}
+
+
+    class VoxelDownsamplingOperator(bpy.types.Operator):
+        bl_idname = "object.pc_voxel_downsample"
+        bl_label = "Downsample point cloud"
+        bl_options = {"REGISTER", "UNDO"}
+
+        voxel_size = bpy.props.FloatProperty(name="Voxel size", default=0.05, min=0.0001, max=1000)
+        representative = bpy.props.EnumProperty(name="Keep", default='CENTROID', items=(
+                ('CENTROID', "Centroid", "Replace the points of each voxel by their average"),
+                ('NEAREST', "Nearest point", "Keep the point closest to the centroid of each voxel"),
+                ))
+
+        def invoke(self, context, event):
+            wm = context.window_manager
+            return wm.invoke_props_dialog(self)
+
+        def execute(self, context):
+            mesh = context.selected_objects[0].data
+            coords = mesh_coords(mesh)
+            kept, centroids = voxel_downsample(coords, self.voxel_size)
+            removed = np.ones(len(coords), dtype=bool)
+            removed[kept] = False
+            delete_vertices(mesh, removed)
+            if self.representative == 'CENTROID': # the vertices left are in their original order
+                mesh.vertices.foreach_set('co', centroids[np.argsort(kept)].astype(np.float32).ravel())
+                mesh.update()
+            self.report({'INFO'}, "%d points removed, %d left"%(removed.sum(), len(kept)))
+            return {'FINISHED'}
+
+
+    class VIEW3D_PT_tools_Meshify(Panel):
+        bl_category = "Tools"
+        bl_context = "objectmode"
+        bl_label = "Point cloud"
+        bl_idname = "OBJECT_OT_pc_clean"
+        bl_space_type = 'VIEW_3D'
+        bl_region_type = 'TOOLS'
+
+        def draw(self, context):
+            layout = self.layout
+            obj = context.object
+            layout.row().operator("object.pc_voxel_downsample", emboss=True)
+            layout.row().operator("object.pc_clean", emboss=True)
+
+    def register():
+        bpy.utils.register_class(PointCloudCleaningOperator)
+        bpy.utils.register_class(VoxelDownsamplingOperator)
+        bpy.utils.register_class(VIEW3D_PT_tools_Meshify)
+
+    def unregister():
+        bpy.utils.unregister_class(VIEW3D_PT_tools_Meshify)
+        bpy.utils.unregister_class(VoxelDownsamplingOperator)
+        bpy.utils.unregister_class(PointCloudCleaningOperator)
 
 if __name__ == "__main__":
+    if bpy is None or '--' in sys.argv: # batch mode
+        sys.exit(batch_main(sys.argv[sys.argv.index('--')+1:] if '--' in sys.argv else sys.argv[1:]))
 
     register()
-    bpy
 
@@ -13,302 +13,1533 @@ import os
 import sys
 import json
 import time
+import argparse
 import itertools
+import traceback
+import threading
 from random import random
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 # requires:
 # scikit-image
 # numpy
+# scipy (installed with scikit-image)
 
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from skimage import measure # find contours
 from skimage.io import imread
+try:
+    import tifffile
+except ImportError: # bundled with older scikit-image versions
+    from skimage.external import tifffile
 
-import bpy
-import bmesh
-from bpy.types import Panel
-from mathutils import Vector, geometry, kdtree
+# marching_cubes is the classic algorithm in older scikit-image versions
+_marching_cubes = getattr(measure, 'marching_cubes_lewiner', None) or measure.marching_cubes
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+try:
+    import bpy
+    from bpy.types import Panel
+    from mathutils import Vector, geometry
+except ImportError: # plain python, only the batch mode is available
+    bpy = None
 
 
 LAYERS = None
 REF_SIZE = None
+RANGE = None
+CACHE_DIR = 'contours.cache'
+VOLUME_EXTENSIONS = ('.npy', '.raw', '.bin', '.tif', '.tiff')
 
 def get_z_from_layer(layer):
     return ((LAYERS - layer)/LAYERS)*REF_SIZE
 
+def in_range(layer):
+    return not RANGE or RANGE[0] <= layer <= RANGE[1]
+
+def peak_memory():
+    " High-water mark of the process' resident memory in MB (it never goes down), None if unknown "
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+class Profile:
+    """ Wall time, item count and memory use of each stage of a reconstruction
+
+    Stages running in worker processes report the sum of their workers' times.
+    Memory is only known through the process high-water mark (see `peak_memory`):
+    each stage records how much it raised it and the mark when it ended, so the
+    stages which needed more memory than any stage before stand out.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename # where to save the JSON profile
+        self.stages = OrderedDict()
+        self.current = None # last stage started or measured
+
+    def add(self, name, seconds, items=0, peak_growth=None):
+        self.current = name
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'items': 0, 'peak_growth_mb': None, 'process_peak_mb': None})
+        stage['seconds'] += seconds
+        stage['items'] += items
+        if peak_growth is not None:
+            stage['peak_growth_mb'] = (stage['peak_growth_mb'] or 0) + peak_growth
+        stage['process_peak_mb'] = peak_memory()
+
+    @contextmanager
+    def stage(self, name, items=0):
+        " Times the enclosed code, items can be counted in the `items` attribute of the returned object "
+        counter = _Counter(items)
+        self.current = name
+        peak = peak_memory()
+        start = time.time()
+        try:
+            yield counter
+        finally:
+            seconds = time.time() - start
+            self.add(name, seconds, counter.items, None if peak is None else peak_memory() - peak)
+
+    def summary(self):
+        text = ', '.join('%s %.2fs'%(name, stage['seconds']) for name, stage in self.stages.items())
+        if peak_memory() is not None:
+            text += ', process peak memory %d MB'%peak_memory()
+        return text
+
+    def table(self):
+        lines = ['%-20s %10s %10s %12s %16s'%('stage', 'seconds', 'items', 'peak +MB', 'process peak MB')]
+        for name, stage in self.stages.items():
+            growth = '-' if stage['peak_growth_mb'] is None else '%d'%stage['peak_growth_mb']
+            peak = '-' if stage['process_peak_mb'] is None else '%d'%stage['process_peak_mb']
+            lines.append('%-20s %10.3f %10d %12s %16s'%(name, stage['seconds'], stage['items'], growth, peak))
+        return '\n'.join(lines)
+
+    def save(self, **infos):
+        " Writes the profile to `filename` as JSON, with some extra `infos` "
+        folder = os.path.dirname(self.filename)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        infos['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        infos['stages'] = [dict(stage, name=name) for name, stage in self.stages.items()]
+        with open(self.filename, 'w') as f:
+            json.dump(infos, f, indent=1)
+
+class _Counter:
+    def __init__(self, items):
+        self.items = items
+
+PROFILE = Profile()
+STAGES = {} # last result of each memoized stage, see `memoized`
+
 def listing(path):
     return sorted((x for x in os.listdir(path) if x.endswith('.png') and not x.startswith('contour_')))
 
-
-class SimpleOperator(bpy.types.Operator):
-    bl_idname = "object.meslicify"
-    bl_label = "Import slices"
-    bl_options = {'REGISTER','UNDO'}
-
-    decimation_factor = bpy.props.IntProperty(name="Decimation factor", default=2, min=1, max=100)
-    face_tolerance = bpy.props.IntProperty(name="Face tolerance", default=50, min=1, max=1000)
-    max_tension = bpy.props.FloatProperty(name="Max tension", default=20.0, min=0.01, max=1000)
-    simplification_factor = bpy.props.FloatProperty(name="Simplify", default=0, min=0, max=2)
-    scale = bpy.props.FloatProperty(name="Scale", default=1, min=0.01, max=10)
-
-    contours_max = bpy.props.IntProperty(name="Feat. detection: max / slice", default=100, min=1, max=500)
-    contours_min_size = bpy.props.IntProperty(name="Feat. detection minimum size", default=200, min=3, max=20000)
-    contours_threshold = bpy.props.FloatProperty(name="Threshold", default=0.01, min=0, max=1)
-
-    remove_doubles = bpy.props.BoolProperty(name="Remove doubles", default=True)
+def load_slice(filename, step=1, dtype=None):
+    """ Returns the first channel of an image file as a 2D array
+
+    Gray, gray+alpha, RGB and RGBA images are supported, colored images are
+    returned as a view on their first channel so no pixel is copied.
+    `step` keeps one pixel every `step` in both directions and `dtype`
+    converts the data while loading (only copies when the type differs).
+    """
+    return _first_channel(imread(filename), step, dtype)
+
+def _first_channel(data, step=1, dtype=None):
+    if data.ndim == 3:
+        data = data[:, :, 0]
+    if step > 1:
+        data = data[::step, ::step]
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return data
+
+class ImageStack:
+    " Folder of images, one per slice "
+    def __init__(self, path):
+        self.path = path
+        self.names = listing(path)
+        self.cache_root = os.path.join(path, CACHE_DIR)
+
+    def __len__(self):
+        return len(self.names)
+
+    def read(self, layer, step=1, dtype=None):
+        " Returns a slice as a 2D array, see `load_slice` "
+        return load_slice(os.path.join(self.path, self.names[layer]), step, dtype)
+
+    def key(self, layer):
+        " Changes when the slice file is modified "
+        st = os.stat(os.path.join(self.path, self.names[layer]))
+        return [st.st_mtime, st.st_size]
+
+
+class _TiffPages:
+    " Pages of a TIFF file which can't be memory-mapped, decoded on demand "
+    def __init__(self, filename):
+        self.tiff = tifffile.TiffFile(filename)
+
+    def __len__(self):
+        return len(self.tiff.pages)
+
+    def __getitem__(self, layer):
+        return self.tiff.pages[layer].asarray()
+
+
+class VolumeStack:
+    """ Volume file, memory-mapped so only the slices which are read are loaded
+
+    Supports numpy (.npy), multi-page TIFF and raw files, for the latter
+    `shape` (slices, rows, columns) and `dtype` must be given.
+    """
+    def __init__(self, path, shape=None, dtype=None):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self._data = None
+        self.names = ['%s:%d'%(os.path.basename(path), layer) for layer in range(len(self.data))]
+        self.cache_root = '%s.%s'%(path, CACHE_DIR)
+
+    @property
+    def data(self):
+        if self._data is None:
+            ext = os.path.splitext(self.path)[1].lower()
+            if ext == '.npy':
+                self._data = np.load(self.path, mmap_mode='r')
+            elif ext in ('.tif', '.tiff'):
+                try:
+                    self._data = tifffile.memmap(self.path, mode='r')
+                except ValueError: # compressed or not contiguous
+                    self._data = _TiffPages(self.path)
+            else:
+                if not self.shape or None in self.shape or not self.dtype:
+                    raise ValueError("shape and data type are required to read %s"%self.path)
+                self._data = np.memmap(self.path, dtype=self.dtype, mode='r', shape=tuple(self.shape))
+        return self._data
+
+    def __getstate__(self): # sent to worker processes: don't copy the data
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.names)
+
+    def read(self, layer, step=1, dtype=None):
+        " Returns a slice as a 2D array, only reading the pixels which are kept "
+        return _first_channel(self.data[layer], step, dtype)
+
+    def key(self, layer):
+        " Changes when the volume file is modified "
+        st = os.stat(self.path)
+        return [st.st_mtime, st.st_size]
+
+def open_stack(path, shape=None, dtype=None):
+    " Returns the slices of a folder of images or of a volume file (see `VolumeStack`) "
+    if os.path.splitext(path)[1].lower() in VOLUME_EXTENSIONS and os.path.isfile(path):
+        return VolumeStack(path, shape, dtype)
+    return ImageStack(path)
+
+def pool_map(function, workers, *iterables):
+    """ Same as map(), using `workers` processes if more than one
+
+    Workers may be spawned rather than forked, so `function` must not rely on
+    this module's state (LAYERS, REF_SIZE...). Results are still returned in
+    order, only a few calls per worker are queued ahead: closing the generator
+    early (e.g. on Cancelled) drops the rest.
+    """
+    if workers <= 1:
+        yield from map(function, *iterables)
+        return
+    pool = ProcessPoolExecutor(workers)
+    pending = deque()
+    try:
+        for args in zip(*iterables):
+            pending.append(pool.submit(function, *args))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+def memoized(stage, key, function, *args):
+    """ Returns function(*args), reusing the last result of `stage` if it was made with the same `key`
+
+    Only the last result of each stage is kept. Results are shared, they must
+    not be modified. A None `key` disables the memoization.
+    """
+    last = STAGES.get(stage)
+    if key is not None and last is not None and last[0] == key:
+        return last[1]
+    result = function(*args)
+    if key is not None:
+        STAGES[stage] = (key, result)
+    return result
+
+def roi_box(data, threshold):
+    """ Returns the first and end rows and columns of the pixels at or above `threshold`
+
+    The box is grown by one pixel so that it holds every crossing of the
+    threshold, it is None when no pixel reaches it.
+    """
+    rows = np.flatnonzero((data >= threshold).any(axis=1))
+    if not len(rows):
+        return None
+    top, bottom = max(rows[0]-1, 0), min(rows[-1]+2, data.shape[0])
+    columns = np.flatnonzero((data[top:bottom] >= threshold).any(axis=0))
+    return top, bottom, max(columns[0]-1, 0), min(columns[-1]+2, data.shape[1])
+
+def find_slice_contours(data, threshold, step=1, crop=True):
+    """ Returns the contours of a loaded slice as (N, 2) arrays, in full resolution coordinates
+
+    Contours aren't filtered, the small ones and the ones after the maximum
+    count are only dropped by `decimate_layer` so that the cache doesn't
+    depend on these settings.
+
+    With `crop`, the contours are only searched in the box of the content
+    (see `roi_box`), which gives the same contours for a fraction of the pixels.
+    """
+    if not crop:
+        contours = measure.find_contours(data, threshold)
+    else:
+        box = roi_box(data, threshold)
+        if box is None: # empty slice
+            return []
+        top, bottom, left, right = box
+        contours = measure.find_contours(data[top:bottom, left:right], threshold)
+        if top or left: # back to slice coordinates
+            contours = [c + (top, left) for c in contours]
+    if step > 1: # back to full resolution coordinates
+        contours = [c * step for c in contours]
+    return contours
+
+def _timed_extract_levels(stack, layer, thresholds, step=1):
+    """ Reads one slice and returns its contours for each of `thresholds` (see `find_slice_contours`)
+
+    Also returns the time spent decoding and finding contours. Runs in the
+    worker processes of the parallel extraction.
+    """
+    start = time.time()
+    data = stack.read(layer, step)
+    decoded = time.time()
+    levels = [find_slice_contours(data, threshold, step) for threshold in thresholds]
+    return levels, decoded - start, time.time() - decoded
+
+def _load_array(filename):
+    try:
+        return np.load(filename, mmap_mode='r')
+    except ValueError: # empty arrays can't be mapped
+        return np.load(filename)
+
+
+class ContourCache:
+    """ Contours of a whole stack stored as flat arrays
+
+    `coords` holds the float32 (y, x) points of every contour one after the
+    other, `offsets` and `sizes` give the first row and the number of points of
+    each contour and `layers` the index of the first contour of each layer
+    (with a final end marker). Once saved, the arrays are memory-mapped so only
+    the layers which are actually used are read from disk.
+    `index` tells, for each layer, the slice it was read from (see `update_contour_cache`)
+    and `path` is the folder the cache was loaded from or saved to.
+    """
+    FILES = ('coords', 'offsets', 'sizes', 'layers')
+
+    def __init__(self, coords, offsets, sizes, layers, index=None):
+        self.coords = coords
+        self.offsets = offsets
+        self.sizes = sizes
+        self.layers = layers
+        self.index = index
+        self.path = None
+
+    @classmethod
+    def from_layers(cls, layers, index=None):
+        " Builds the cache from a list (one item per layer) of lists of (N, 2) arrays "
+        contours = [c for layer in layers for c in layer]
+        sizes = np.array([len(c) for c in contours], dtype=np.int32)
+        offsets = np.zeros(len(contours), dtype=np.int64)
+        np.cumsum(sizes[:-1], out=offsets[1:])
+        coords = np.empty((int(sizes.sum()), 2), dtype=np.float32)
+        for start, c in zip(offsets, contours):
+            coords[start:start+len(c)] = c
+        layer_index = np.zeros(len(layers)+1, dtype=np.int64)
+        np.cumsum([len(layer) for layer in layers], out=layer_index[1:])
+        return cls(coords, offsets, sizes, layer_index, index)
+
+    @classmethod
+    def from_layer_arrays(cls, coords, sizes):
+        """ Builds the cache from the (N, 2) points of each layer and the number of points of its contours
+
+        The contours of a layer are stored one after the other, see `layer_points`.
+        """
+        layer_index = np.zeros(len(sizes)+1, dtype=np.int64)
+        np.cumsum([len(layer_sizes) for layer_sizes in sizes], out=layer_index[1:])
+        sizes = _concat(sizes, 0, np.int32)
+        offsets = np.zeros(len(sizes), dtype=np.int64)
+        np.cumsum(sizes[:-1], out=offsets[1:])
+        return cls(_concat(coords, (0, 2), np.float32), offsets, sizes, layer_index)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        cache = cls(*(_load_array(os.path.join(path, '%s.npy'%name)) for name in cls.FILES), index=index)
+        cache.path = os.path.abspath(path)
+        return cache
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # write aside then rename: the previous files may still be mapped
+        for name in self.FILES:
+            with open(os.path.join(path, '%s.tmp'%name), 'wb') as f:
+                np.save(f, getattr(self, name))
+            os.replace(os.path.join(path, '%s.tmp'%name), os.path.join(path, '%s.npy'%name))
+        with open(os.path.join(path, 'index.tmp'), 'w') as f:
+            json.dump(self.index, f)
+        os.replace(os.path.join(path, 'index.tmp'), os.path.join(path, 'index.json'))
+        self.path = os.path.abspath(path)
+
+    def __len__(self):
+        return len(self.layers) - 1
+
+    def layer_arrays(self, num):
+        " Returns the contours of a layer as views on the cache "
+        return [self.coords[self.offsets[n]:self.offsets[n]+self.sizes[n]]
+                for n in range(self.layers[num], self.layers[num+1])]
+
+    def layer_sizes(self, num):
+        " Returns the number of points of each contour of a layer "
+        return self.sizes[self.layers[num]:self.layers[num+1]]
+
+    def layer_points(self, num):
+        " Returns the points of all the contours of a layer, which are stored one after the other "
+        first, last = self.layers[num], self.layers[num+1]
+        if first == last:
+            return self.coords[:0]
+        return self.coords[self.offsets[first]:self.offsets[last-1]+self.sizes[last-1]]
+
+
+def contour_cache_dir(stack, threshold):
+    return os.path.join(stack.cache_root, '%g'%threshold)
+
+def slice_key(stack, layer, params):
+    return stack.key(layer) + [list(params)]
+
+def load_contour_cache(stack, params):
+    """ Loads the contours cache of a stack for the given extraction params, None if not found
+
+    Caches from older versions (`contours.js`) are converted on the fly, they
+    are assumed to have been made with the current settings.
+    """
+    cache_dir = contour_cache_dir(stack, params[0])
+    if os.path.exists(os.path.join(cache_dir, 'index.json')):
+        return ContourCache.load(cache_dir)
+    json_file = os.path.join(stack.path, 'contours.js')
+    if os.path.isdir(stack.path) and os.path.exists(json_file):
+        with open(json_file) as f:
+            layers = json.load(f)['contours']
+        if len(layers) != len(stack): # made from a subrange, layers can't be matched to files
+            return None
+        print("Converting %s..."%json_file)
+        layers = [[np.array(c['coords'], dtype=np.float32).reshape(-1, 2) for c in layer] for layer in layers]
+        index = [{'name': name, 'key': slice_key(stack, layer, params)} for layer, name in enumerate(stack.names)]
+        cache = ContourCache.from_layers(layers, index)
+        cache.save(cache_dir)
+        return cache
+
+def update_contour_cache(stack, params, wm, subrange=None, workers=1, force=False):
+    """ Returns the contours cache of a stack, reading the slices it misses
+
+    Layers are keyed by slice name, modification time, size and extraction
+    `params` (threshold and load step, see `find_slice_contours`).
+    Only the layers of `subrange` (all by default) which are missing or out of
+    date are read, the other ones are kept as they are, or left empty, so that
+    layer numbers always match the slices.
+    """
+    return update_contour_caches(stack, [params[0]], params, wm, subrange, workers, force)[0]
+
+def update_contour_caches(stack, thresholds, params, wm, subrange=None, workers=1, force=False):
+    """ Returns the contours cache of a stack for each of `thresholds`, see `update_contour_cache`
+
+    Each level has its own cache, the other extraction `params` are shared.
+    A slice missing from several caches is read once for all of them.
+    """
+    files = stack.names
+    levels = [] # params, layer keys, cache, layers and index of each threshold
+    with PROFILE.stage('cache load', len(files) * len(thresholds)):
+        for threshold in thresholds:
+            level_params = (threshold,) + tuple(params[1:])
+            keys = [slice_key(stack, layer, level_params) for layer in range(len(files))]
+            cache = None if force else load_contour_cache(stack, level_params)
+            levels.append((level_params, keys, cache) + _reuse_layers(cache, files, keys))
+
+    wanted = range(len(files)) if subrange is None else range(max(0, subrange[0]), min(len(files), subrange[1]+1))
+    caches = [None] * len(levels)
+    needed = {} # layer -> levels to read it for
+    for num, (level_params, keys, cache, layers, index) in enumerate(levels):
+        todo = [layer for layer in wanted if index[layer]['key'] is None]
+        if cache is not None and not todo and cache.index == index:
+            caches[num] = cache
+        for layer in todo:
+            needed.setdefault(layer, []).append(num)
+    if all(cache is not None for cache in caches):
+        return caches
+
+    todo = sorted(needed)
+    wm.progress_begin(0, len(files))
+    args = [itertools.repeat(stack), todo, [[thresholds[num] for num in needed[layer]] for layer in todo]]
+    args += [itertools.repeat(p) for p in params[1:]]
+
+    # slices are independent, they can be read in worker processes
+    for layer, (contours, decode_time, contours_time) in zip(todo, pool_map(_timed_extract_levels, workers, *args)):
+        wm.progress_update(layer)
+        sys.stderr.write('\rReading... %30s '%(files[layer]))
+        sys.stderr.flush()
+        for num, level_contours in zip(needed[layer], contours):
+            level_params, keys, cache, layers, index = levels[num]
+            layers[layer] = level_contours
+            index[layer]['key'] = keys[layer]
+        PROFILE.add('image decode', decode_time, 1)
+        PROFILE.add('find_contours', contours_time, sum(len(c) for c in contours))
+    wm.progress_end()
+
+    print("Saving...")
+    with PROFILE.stage('cache save', len(files)):
+        for num, (level_params, keys, cache, layers, index) in enumerate(levels):
+            if caches[num] is None:
+                caches[num] = ContourCache.from_layers(layers, index)
+                caches[num].save(contour_cache_dir(stack, level_params[0]))
+    return caches
+
+def _reuse_layers(cache, files, keys):
+    " Returns the layers of `cache` which are still valid, and the index of the slices they were read from "
+    layers = [[] for f in files]
+    index = [{'name': f, 'key': None} for f in files]
+    if cache is not None:
+        positions = dict((f, layer) for layer, f in enumerate(files))
+        for num, entry in enumerate(cache.index):
+            layer = positions.get(entry['name'])
+            if layer is not None and entry['key'] == keys[layer]:
+                layers[layer] = cache.layer_arrays(num)
+                index[layer]['key'] = keys[layer]
+    return layers, index
+
+def decimate_contours(coords, sizes, decimations, simplification):
+    """ Returns the masks of the points to keep for each decimation factor, slopes are computed once
+
+    The first point of a contour is always kept, then a point is dropped when
+    it is vertically aligned with the previous one, when its index isn't a
+    multiple of the decimation or when its slope differs from the previous
+    slope by no more than `simplification` (if neither is zero).
+
+    Contours are stored one after the other, `sizes` is the number of points
+    of each contour of `coords`, a mask is made of all the points.
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    position = np.arange(len(coords)) - np.repeat(np.cumsum(sizes) - sizes, sizes) # in the contour
+    keep = position == 0
+    if len(coords) > 1:
+        delta = np.diff(np.asarray(coords, dtype=np.float64), axis=0)
+        vertical = delta[:, 0] == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tan = np.where(vertical, 0, delta[:, 1] / delta[:, 0])
+        kept = ~vertical & (position[1:] > 0) # deltas between two contours are meaningless
+        if simplification:
+            prev_tan = np.concatenate(([0], tan[:-1]))
+            prev_tan[position[1:] == 1] = 0 # no previous slope for the 2nd point
+            kept &= ~((prev_tan != 0) & (np.abs(prev_tan - tan) <= simplification))
+        keep[1:] |= kept
+
+    return [keep & (position % decimation == 0) for decimation in decimations]
+
+def decimate_layer(cache, num, decimations, simplification, min_size, max_count):
+    """ Returns the points and contour sizes of a layer of `cache` decimated with each of `decimations`
+
+    Contours smaller than `min_size` (counting both coordinates) or after the
+    first `max_count` ones of the slice are dropped, the cache keeps them all.
+    """
+    first, last = cache.layers[num], cache.layers[num+1]
+    sizes = cache.sizes[first:last]
+    selected = (2 * sizes >= min_size) & (np.arange(last - first) <= max_count)
+    sizes = sizes[selected].astype(np.int64)
+    coords = cache.coords[_ragged_ranges(cache.offsets[first:last][selected], sizes)]
+    contour_ids = np.repeat(np.arange(len(sizes)), sizes)
+    return [(coords[mask], np.bincount(contour_ids[mask], minlength=len(sizes)))
+            for mask in decimate_contours(coords, sizes, decimations, simplification)]
+
+def parse_levels(text):
+    """ Returns the sorted decimation factors of a comma separated list
+
+    Raises ValueError when they aren't whole numbers from 1, see `settings_error`.
+    """
+    try:
+        levels = set(int(level) for level in text.replace(',', ' ').split())
+    except ValueError:
+        raise ValueError("LOD decimations must be comma separated whole numbers, not '%s'"%text) from None
+    if any(level < 1 for level in levels):
+        raise ValueError("LOD decimations must be at least 1, not '%s'"%text)
+    return sorted(levels)
+
+def parse_thresholds(text):
+    """ Returns the sorted thresholds of a comma separated list
+
+    Raises ValueError when they aren't finite numbers, see `settings_error`.
+    """
+    try:
+        thresholds = set(float(level) for level in text.replace(',', ' ').split())
+    except ValueError:
+        raise ValueError("Threshold sweep must be comma separated numbers, not '%s'"%text) from None
+    if not all(np.isfinite(threshold) for threshold in thresholds):
+        raise ValueError("Threshold sweep must be finite numbers, not '%s'"%text)
+    return sorted(thresholds)
+
+def _ragged_ranges(starts, counts):
+    " Concatenation of range(start, start+count) for every start/count pair "
+    steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + steps
+
+def stitch_layer(lengths, first_vertex, nearest, max_tension):
+    """ Returns the edges and faces linking a layer to the layer below
+
+    `lengths` is the number of points of each contour of the layer, numbered
+    from `first_vertex`, and `nearest` a (distances, indices) pair giving the
+    closest vertex below each of them (None if the layer below is empty).
+    Faces are returned as a flat array of vertex indices plus their sizes.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    count = int(lengths.sum())
+    if nearest is None or not count:
+        return np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    dist, below = nearest
+
+    local = np.arange(count)
+    vtx = first_vertex + local
+    p_i = local - np.repeat(np.cumsum(lengths) - lengths, lengths) # position in the contour
+    # previous vertex, the first one of a contour is linked to the last one
+    left = np.where(p_i > 0, vtx - 1, vtx + np.repeat(lengths, lengths) - 1)
+    former = np.concatenate(([0], below[:-1])) # vertex below the previous point
+    linked = dist < max_tension
+
+    edges = np.column_stack((left, vtx, vtx, below))[linked].reshape(-1, 2)
+
+    # triangles when both points share the same vertex below, else a polygon
+    # running along the layer below (when it has at least 3 vertices)
+    tri = linked & (former == below)
+    poly = linked & ~tri & (p_i > 0) & (below >= former)
+    is_face = tri | poly
+    sizes = np.where(tri, 3, below - former + 3)[is_face]
+    starts = np.cumsum(sizes) - sizes
+    faces = np.empty(int(sizes.sum()), dtype=np.int64)
+
+    tri_starts = starts[tri[is_face]]
+    faces[tri_starts] = left[tri]
+    faces[tri_starts+1] = below[tri]
+    faces[tri_starts+2] = vtx[tri]
+
+    poly_starts = starts[poly[is_face]]
+    faces[poly_starts] = vtx[poly]
+    faces[poly_starts+1] = left[poly]
+    span = below[poly] - former[poly] + 1
+    faces[_ragged_ranges(poly_starts+2, span)] = _ragged_ranges(former[poly], span)
+    return edges, faces, sizes
+
+def layer_tree(points):
+    """ Spatial index of the (y, x) `points` of a layer, None if empty
+
+    Layers are matched in the plane: both share one z, which doesn't change
+    the distances, and the workers don't need the stack's layout.
+    """
+    if not len(points):
+        return None
+    return cKDTree(points)
+
+def query_layer(tree, points, first_vertex):
+    " Returns the distances & vertex indices of the closest points of a layer's `tree` to the (y, x) `points` "
+    if tree is None:
+        return None
+    dist, idx = tree.query(points)
+    return dist, idx + first_vertex
+
+def mesh_layer(points, lengths, first_vertex, below_points, below_first_vertex, max_tension):
+    " Stitches a layer to the layer below from their points only (see `stitch_layer`) "
+    nearest = query_layer(layer_tree(below_points), points, below_first_vertex)
+    return stitch_layer(lengths, first_vertex, nearest, max_tension)
+
+def volume_chunk_mesh(stack, layers, step, level):
+    """ Extracts the isosurface at `level` of the slices `layers` (evenly spaced by `step`)
+
+    Returns the vertices as full resolution (layer, row, column) coordinates and the triangles.
+    """
+    volume = np.stack([stack.read(layer, step, np.float32) for layer in layers])
+    if len(layers) < 2 or not volume.min() < level < volume.max():
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+    verts, faces = _marching_cubes(volume, level, spacing=(step, step, step))[:2]
+    verts[:, 0] += layers[0]
+    return verts, faces
+
+def _concat(arrays, shape, dtype):
+    return np.concatenate(arrays) if arrays else np.empty(shape, dtype=dtype)
+
+def merge_by_distance(verts, edges, faces, face_sizes, distance, candidates=None):
+    """ Merges the vertices closer than `distance` ("Remove doubles")
+
+    Every group of close vertices is replaced by its first vertex, the edges
+    and faces are remapped: collapsed or duplicated edges are removed, and so
+    are faces left with less than 3 vertices. Returns the new arrays.
+    The close vertices can be picked from `candidates`, pairs found further
+    apart by `close_pairs`, instead of being searched again.
+    """
+    with PROFILE.stage('remove_doubles', len(verts)):
+        if candidates is None:
+            pairs = cKDTree(verts).query_pairs(distance, output_type='ndarray')
+        else:
+            pairs, lengths = candidates
+            pairs = pairs[lengths <= distance]
+        return _merge_pairs(verts, edges, faces, face_sizes, pairs)
+
+def close_pairs(verts, distance):
+    " Returns the pairs of vertices closer than `distance` and their lengths "
+    pairs = cKDTree(verts).query_pairs(distance, output_type='ndarray')
+    return pairs, np.sqrt(((verts[pairs[:, 0]] - verts[pairs[:, 1]]) ** 2).sum(axis=1))
+
+def _merge_pairs(verts, edges, faces, face_sizes, pairs):
+    if not len(pairs):
+        return verts, edges, faces, face_sizes
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(verts), len(verts)))
+    labels = connected_components(graph, directed=False)[1]
+    # number the groups in the order of their first vertex
+    first = np.unique(labels, return_index=True)[1]
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[labels[np.sort(first)]] = np.arange(len(first))
+    remap = rank[labels]
+    verts = verts[np.sort(first)]
+
+    edges = np.sort(remap[edges], axis=1)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    if len(edges):
+        edges = edges[np.sort(np.unique(edges, axis=0, return_index=True)[1])]
+
+    faces = remap[faces]
+    face_ids = np.repeat(np.arange(len(face_sizes)), face_sizes)
+    starts = np.cumsum(face_sizes) - face_sizes
+    previous = np.arange(len(faces)) - 1 # previous vertex in the face loop
+    previous[starts] += face_sizes
+    kept = faces != faces[previous]
+    face_sizes = np.bincount(face_ids[kept], minlength=len(face_sizes))
+    kept &= (face_sizes >= 3)[face_ids]
+    return verts, edges, faces[kept], face_sizes[face_sizes >= 3]
+
+def fill_mesh(mesh, verts, edges, faces, face_sizes):
+    " Writes the mesh geometry from arrays, `faces` being the flat vertex indices of faces of `face_sizes` "
+    with PROFILE.stage('mesh build', len(verts)):
+        _fill_mesh(mesh, verts, edges, faces, face_sizes)
+
+def _fill_mesh(mesh, verts, edges, faces, face_sizes):
+    mesh.vertices.add(len(verts))
+    mesh.vertices.foreach_set('co', verts.astype(np.float32).ravel())
+    mesh.edges.add(len(edges))
+    mesh.edges.foreach_set('vertices', edges.astype(np.int32).ravel())
+    mesh.loops.add(len(faces))
+    mesh.loops.foreach_set('vertex_index', faces.astype(np.int32))
+    mesh.polygons.add(len(face_sizes))
+    mesh.polygons.foreach_set('loop_start', (np.cumsum(face_sizes) - face_sizes).astype(np.int32))
+    mesh.polygons.foreach_set('loop_total', face_sizes.astype(np.int32))
+    mesh.update(calc_edges=True)
+    mesh.validate()
+
+
+class SlicesPipeline:
+    """ Reconstruction steps, from the contours cache to the mesh arrays
+
+    Settings are read from attributes named after `SimpleOperator` properties.
+    """
+    def decimate_layers(self, cache, decimations, wm):
+        """ Returns the filtered contours of `cache` decimated with each factor of `decimations`
+
+        Each level is a `ContourCache` kept in memory, the layers out of the
+        range being left empty.
+        """
+        levels = [([], []) for decimation in decimations]
+        empty = (cache.coords[:0], np.empty(0, dtype=np.int64))
+        for num in range(len(cache)):
+            wm.progress_update(num)
+            if in_range(num):
+                layer_levels = decimate_layer(cache, num, decimations,
+                        self.simplification_factor, self.contours_min_size, self.contours_max)
+            else:
+                layer_levels = [empty for decimation in decimations]
+            for (coords, sizes), (layer_coords, layer_sizes) in zip(levels, layer_levels):
+                coords.append(layer_coords)
+                sizes.append(layer_sizes)
+        return [ContourCache.from_layer_arrays(coords, sizes) for coords, sizes in levels]
+
+    def layer_verts(self, points, layer, scale=None):
+        """ Returns the blender coordinates of the (y, x) `points` of a layer
+
+        `layer` may also be an array giving the layer of each point.
+        """
+        scale = self.scale if scale is None else scale
+        ref_offset = -REF_SIZE/2
+        z = get_z_from_layer(layer)
+        return np.column_stack(( # inverted X & Y for blender
+            scale * (points[:, 1]+ref_offset)/REF_SIZE,
+            scale * (points[:, 0]+ref_offset)/REF_SIZE,
+            np.full(len(points), scale * (1 - (z/REF_SIZE))) ))
 
     def process_contours(self, layers, wm):
-        global RANGE
-        _c = itertools.count() # vertex count
+        " Returns the decimated contours of the `layers` cache, see `decimate_layers` "
+        with PROFILE.stage('process_contours', len(layers)):
+            contours = self.decimate_layers(layers, (self.decimation_factor,), wm)[0]
+        self.index_contours(contours)
+        return contours
+
+    def indexed_contours(self, layers, wm):
+        " Returns the result of `process_contours` along with the spatial index it built "
+        contours = self.process_contours(layers, wm)
+        return contours, self.kdtrees, self.tree_offsets
+
+    def contours_key(self, cache):
+        " What the decimated contours of `cache` depend on, None for a cache which isn't on disk "
+        if cache.path is None:
+            return None
+        return (cache.path, json.dumps(cache.index), LAYERS, REF_SIZE, RANGE and tuple(RANGE),
+                self.decimation_factor, self.simplification_factor, self.contours_min_size, self.contours_max)
+
+    def index_contours(self, contours):
+        " Builds the spatial index of every layer of decimated contours "
         kdtrees = []
-        real_contours = []
+        tree_offsets = [] # index of the first vertex of each layer
+        vert_count = 0
 
-        for num, layer in enumerate(layers):
-            wm.progress_update(num)
-            real_contours.append( [] )
-            tree = kdtree.KDTree(sum(contour['size'] for contour in layer))
-
-            if RANGE:
-                if num < RANGE[0] or num > RANGE[1]:
-                    tree.balance()
-                    kdtrees.append(tree)
-                    continue
-
-            z = get_z_from_layer(num)
-
-            for n, contour in enumerate(layer):
-
-                if contour['size'] < self.contours_min_size:
-                    continue
-                if n > self.contours_max:
-                    break
-
-                this_contour = []
-                prev_vert = None
-                prev_tan = None
-                for rel_nr, v in enumerate(contour['coords']):
-                    skipped = False
-                    if prev_vert:
-                        try:
-                            tan = (v[1]-prev_vert[1]) / (v[0]-prev_vert[0])
-                        except ZeroDivisionError:
-                            skipped = True
-                            tan = 0
-                        else:
-                            if rel_nr%self.decimation_factor or (prev_tan and self.simplification_factor and abs(prev_tan-tan) <= self.simplification_factor):
-                                skipped = True
-                        prev_tan = tan
-                    prev_vert = v
-                    if not skipped:
-                        co = (v[0], v[1], z)
-                        tree.insert(co, next(_c))
-                        this_contour.append(co)
-                real_contours[-1].append(this_contour)
-
-            tree.balance()
-            kdtrees.append(tree)
+        with PROFILE.stage('kdtree build') as stage:
+            for num in range(len(contours)):
+                tree_offsets.append(vert_count)
+                points = contours.layer_points(num)
+                kdtrees.append(layer_tree(points))
+                vert_count += len(points)
+            stage.items = vert_count
 
         self.kdtrees = kdtrees
-        return real_contours
+        self.tree_offsets = tree_offsets
+
+    def gen_mesh(self, contours, wm):
+        points, layers, edges, faces, face_sizes = self.stitch_contours(contours, wm)
+        return self.layer_verts(points, layers), edges, faces, face_sizes
 
-    def gen_mesh(self, real_contours, wm):
+    def stitch_contours(self, contours, wm):
+        """ Stitches every layer of decimated contours to the one below
+
+        Returns the (y, x) points and the layer of each of them, the edges,
+        faces and face sizes, the vertices being left in layer coordinates.
+        """
         verts = []
+        verts_layers = []
         edges = []
         faces = []
-        vert_count = itertools.count()
-
-        tot_vtx = itertools.count()
-        ref_offset = -REF_SIZE/2
+        face_sizes = []
 
-        for layer, contours in enumerate(real_contours): # from bottom to top
+        for layer in range(len(contours)): # from bottom to top
             wm.progress_update(layer)
-            if RANGE:
-                if layer < RANGE[0]:
-                    continue
-                elif layer > RANGE[1]:
-                    continue
-            z = get_z_from_layer(layer)
-
-            vx_idx = 0
-            for contour in contours:
-                #print("C %d"%(len(contour)))
-
-                for p_i, p in enumerate(contour):
-                    # add vertex                    
-                    verts.append(( # inverted X & Y for blender
-                        self.scale * (p[1]+ref_offset)/REF_SIZE,
-                        self.scale * (p[0]+ref_offset)/REF_SIZE,
-                        self.scale * (1 - (z/REF_SIZE))) )
-
-                    former_bottom_idx = vx_idx
-                    # find the two nearest vertices & make two triangles
-                    bottom_vx, vx_idx, dist = self.get_nearest(layer-1, p[0], p[1])
-                    i = next(tot_vtx)
-
-                    if  dist != None and dist < self.max_tension:
-                        # add edge
-                        if p_i:
-                            left_idx = i-1
-                        else: # if first vertex, link last
-                            left_idx = i+len(contour)-1
-                            #former_bottom_idx = get_nearest(layer-1, contour[-1][0], contour[-1][1])[1]
-
-                        edges.append((left_idx, i))
-
-                        if bottom_vx:
-                            edges.append( (i, vx_idx) )
-
-                            if former_bottom_idx == vx_idx: # tri
-                               faces.append( (left_idx, vx_idx, i) )
-                            else:
-                                if p_i > 0:
-                                    faces.append( [i, left_idx] + list(range(former_bottom_idx, vx_idx+1)) )
-        return verts, edges, faces
-
-    #cf: https://www.blender.org/api/blender_python_api_2_73_release/mathutils.kdtree.html
-    def get_nearest(self, layer, x, y):
-        return self.kdtrees[layer].find([x,y, get_z_from_layer(layer)])
-
-    def execute(self, context):
-        global LAYERS
-        global REF_SIZE
-        global RANGE
-        obj = context.selected_objects[0]
-        print("Reloading state...")
-        REF_SIZE = obj.source_slices_size # Z dimmension will be adapted accordingly
-        DIM = [REF_SIZE, REF_SIZE, obj.source_slices_nr]
-        LAYERS = DIM[2]
-        PATH = obj.source_slices # os.path.dirname(context.scene.render.filepath)
-        if obj.partial_slices:
-            RANGE = [obj.partial_slices_start, obj.partial_slices_end]
-
-        c_cache_file = os.path.join(PATH, 'contours.js')
-        if os.path.exists(c_cache_file) and not 'REREAD' in os.environ:
-            c_cache = json.load(open(c_cache_file))
-        else:
-            c_cache = False
-
-        all_files = tuple(listing(PATH))
-
-        dirty = not c_cache
-
-        wm = bpy.context.window_manager # notify progress
-
-        if dirty:
-            wm.progress_begin(0, len(all_files))
-            c_cache = {
-                    'contours': []
-                    }
-
-            for layer, filename in enumerate(all_files):
-                wm.progress_update(layer)
-                if RANGE:
-                    if layer < RANGE[0]:
-                        continue
-                    elif layer > RANGE[1]:
-                        continue
-
-                sys.stderr.write('\rReading... %30s '%(filename))
-                sys.stderr.flush()
-
-                src = imread(os.path.join(PATH, filename))
-                try:
-                    width, height, depth = src.shape
-                    data = np.array([ [src[y][x][0] for x in range(width)] for y in range(height) ])
-                except ValueError:
-                    width, height = src.shape
-                    data = np.array([ [src[y][x] for x in range(width)] for y in range(height) ])
-
-                contours = measure.find_contours(data, self.contours_threshold)
-                c_cache['contours'].append([{'size': int(c.size), 'coords': [tuple(pos[:2]) for pos in c]} for c in contours])
+            points = contours.layer_points(layer).astype(np.float64)
+            if not in_range(layer) or not len(points):
+                continue
+            verts.append(points)
+            verts_layers.append(np.full(len(points), layer, dtype=np.int64))
+
+            # find the nearest vertices below & make faces with them
+            layer_edges, layer_faces, layer_sizes = stitch_layer(contours.layer_sizes(layer),
+                    self.tree_offsets[layer], self.get_nearest(layer-1, points), self.max_tension)
+            edges.append(layer_edges)
+            faces.append(layer_faces)
+            face_sizes.append(layer_sizes)
+
+        return (_concat(verts, (0, 2), np.float64), _concat(verts_layers, 0, np.int64), _concat(edges, (0, 2), np.int64),
+                _concat(faces, 0, np.int64), _concat(face_sizes, 0, np.int64))
+
+    def get_nearest(self, layer, points):
+        if layer < 0: # first layer, nothing below
+            return None
+        return query_layer(self.kdtrees[layer], points, self.tree_offsets[layer])
+
+    def stream_mesh(self, layers, wm):
+        """ Same as process_contours + gen_mesh, but handles the layers one after the other
+
+        Only the previous layer's index is kept, the geometry is gathered in
+        one chunk of arrays per layer.
+        """
+        verts = []
+        edges = []
+        faces = []
+        face_sizes = []
+        prev_tree = None
+        prev_offset = 0
+        vert_count = 0
 
-            print("Saving...")
+        for num in range(len(layers)):
+            wm.progress_update(num)
+            if not in_range(num):
+                prev_tree = None
+                continue
+            points, lengths = decimate_layer(layers, num, (self.decimation_factor,),
+                    self.simplification_factor, self.contours_min_size, self.contours_max)[0]
+            if not len(points):
+                prev_tree = None
+                continue
+            points = points.astype(np.float64)
+            verts.append(self.layer_verts(points, num))
+
+            layer_edges, layer_faces, layer_sizes = stitch_layer(lengths,
+                    vert_count, query_layer(prev_tree, points, prev_offset), self.max_tension)
+            edges.append(layer_edges)
+            faces.append(layer_faces)
+            face_sizes.append(layer_sizes)
+
+            prev_tree = layer_tree(points)
+            prev_offset = vert_count
+            vert_count += len(points)
+
+        return (_concat(verts, (0, 3), np.float64), _concat(edges, (0, 2), np.int64),
+                _concat(faces, 0, np.int64), _concat(face_sizes, 0, np.int64))
+
+    def parallel_mesh(self, layers, wm):
+        """ Same as process_contours + gen_mesh, stitching pairs of layers in `workers` processes
+
+        Layers are decimated first so the index of their first vertex is
+        known, results are joined in layer order.
+        """
+        contours = self.decimate_layers(layers, (self.decimation_factor,), wm)[0]
+        points = [contours.layer_points(num).astype(np.float64) for num in range(len(contours))]
+        offsets = np.cumsum([0] + [len(p) for p in points])
+
+        jobs = [num for num in range(len(points)) if len(points[num])]
+        args = (
+                [points[num] for num in jobs],
+                [contours.layer_sizes(num) for num in jobs],
+                [offsets[num] for num in jobs],
+                [points[num-1] if num else points[num][:0] for num in jobs],
+                [offsets[num-1] for num in jobs],
+                itertools.repeat(self.max_tension),
+                )
+        verts = []
+        edges = []
+        faces = []
+        face_sizes = []
+        for num, (layer_edges, layer_faces, layer_sizes) in zip(jobs, pool_map(mesh_layer, self.workers, *args)):
+            wm.progress_update(num)
+            verts.append(self.layer_verts(points[num], num))
+            edges.append(layer_edges)
+            faces.append(layer_faces)
+            face_sizes.append(layer_sizes)
+
+        return (_concat(verts, (0, 3), np.float64), _concat(edges, (0, 2), np.int64),
+                _concat(faces, 0, np.int64), _concat(face_sizes, 0, np.int64))
+
+    def build_geometry(self, cache, wm):
+        """ Returns the vertices, edges, faces and face sizes of the mesh made from the contours `cache`
+
+        With the contours engine, the decimated contours, the stitching and the
+        merged geometry are memoized (see `memoized`) so that a new max tension
+        only stitches again, etc. Vertices are merged at scale 1 from memoized
+        candidate pairs (see `merge_candidates`), a new scale only picks the
+        pairs which are close enough and transforms the vertices.
+        """
+        if self.engine in ('STREAMING', 'PARALLEL'):
+            print('Generating Mesh data')
+            wm.progress_begin(0, len(cache))
+            with PROFILE.stage(self.engine.lower() + ' mesh') as stage:
+                if self.engine == 'STREAMING':
+                    verts, edges, faces, face_sizes = self.stream_mesh(cache, wm)
+                else:
+                    verts, edges, faces, face_sizes = self.parallel_mesh(cache, wm)
+                stage.items = len(verts)
             wm.progress_end()
-            json.dump(c_cache, open(c_cache_file, 'w'))
+            if self.remove_doubles:
+                verts, edges, faces, face_sizes = merge_by_distance(verts, edges, faces, face_sizes, self.merge_distance)
+            return verts, edges, faces, face_sizes
 
+        key = self.contours_key(cache)
         print("\nGenerating K-D Trees")
 
-        wm.progress_begin(0, len(c_cache['contours']))
-        real_contours = self.process_contours(c_cache['contours'], wm)
+        wm.progress_begin(0, len(cache))
+        contours, self.kdtrees, self.tree_offsets = memoized('contours', key, self.indexed_contours, cache, wm)
         wm.progress_end()
 
-
         print('Generating Mesh data')
 
-        wm.progress_begin(0, len(real_contours))
-        verts, edges, faces = self.gen_mesh(real_contours, wm)
+        key = key and key + (self.max_tension,)
+        wm.progress_begin(0, len(contours))
+        with PROFILE.stage('gen_mesh') as stage:
+            points, layers, edges, faces, face_sizes = memoized('stitch', key, self.stitch_contours, contours, wm)
+            stage.items = len(points)
         wm.progress_end()
 
-        mesh = bpy.data.meshes.new("Made from slices")
-        new_obj = bpy.data.objects.new("FromSlices", mesh)
-
-        scene = bpy.context.scene
-        scene.objects.link(new_obj)  # put the object into the scene (link)
-        scene.objects.active = new_obj  # set as the active object in the scene
-        new_obj.select = True  # select object
-
-        mesh = new_obj.data
-        bm = bmesh.new()
-
-        for i, v in enumerate(verts):
-            bm.verts.new(v)  # add a new vert
-
-        bm.verts.ensure_lookup_table() # required to iterate the edges
+        verts = self.layer_verts(points, layers, 1.0)
+        if self.remove_doubles:
+            distance = self.merge_distance / self.scale
+            candidates = self.merge_candidates(key, verts, distance)
+            key = key and key + (distance,)
+            verts, edges, faces, face_sizes = memoized('remove_doubles', key,
+                    merge_by_distance, verts, edges, faces, face_sizes, distance, candidates)
+        return verts * self.scale, edges, faces, face_sizes
+
+    def merge_candidates(self, key, verts, distance):
+        """ Returns the pairs of `verts` up to a few times `distance` apart, see `close_pairs`
+
+        They are memoized along with that reach, and reused as long as the
+        stitched mesh `key` is the same and its reach covers `distance`.
+        """
+        last = STAGES.get('merge candidates')
+        if key is not None and last is not None and last[0] == key and last[1][0] >= distance:
+            return last[1][1]
+        reach = 4 * distance
+        candidates = close_pairs(verts, reach)
+        if key is not None:
+            STAGES['merge candidates'] = (key, (reach, candidates))
+        return candidates
+
+    def volume_mesh(self, stack, wm):
+        """ Returns the mesh arrays of the isosurface of the slices volume at `contours_threshold`
+
+        The volume is read by chunks of `volume_chunk` slices (sharing one slice
+        with the next chunk) which can be processed by `workers` processes.
+        """
+        first, last = (max(0, RANGE[0]), min(RANGE[1], len(stack)-1)) if RANGE else (0, len(stack)-1)
+        layers = list(range(first, last+1, self.load_step))
+        size = max(2, self.volume_chunk)
+        chunks = [layers[start:start+size] for start in range(0, len(layers)-1, size-1)]
+
+        print('Generating Mesh data (volume)')
+        wm.progress_begin(0, len(chunks))
+        verts = []
+        faces = []
+        vert_count = 0
+        args = (itertools.repeat(stack), chunks,
+                itertools.repeat(self.load_step), itertools.repeat(self.contours_threshold))
+        with PROFILE.stage('marching_cubes', len(layers)):
+            for num, (chunk_verts, chunk_faces) in enumerate(pool_map(volume_chunk_mesh, self.workers, *args)):
+                wm.progress_update(num)
+                verts.append(chunk_verts)
+                faces.append(chunk_faces.ravel() + vert_count)
+                vert_count += len(chunk_verts)
+        wm.progress_end()
 
-        for e in edges: # add edges
-            bm.edges.new(tuple(bm.verts[c] for c in e))
+        points = _concat(verts, (0, 3), np.float64)
+        ref_offset = -REF_SIZE/2
+        verts = np.column_stack(( # inverted X & Y for blender
+            self.scale * (points[:, 2]+ref_offset)/REF_SIZE,
+            self.scale * (points[:, 1]+ref_offset)/REF_SIZE,
+            self.scale * (1 - (get_z_from_layer(points[:, 0])/REF_SIZE)) ))
+        faces = _concat(faces, 0, np.int64)
+        face_sizes = np.full(len(faces)//3, 3, dtype=np.int64)
+        edges = np.empty((0, 2), dtype=np.int64)
+
+        # vertices of the slices shared by two chunks are found twice
+        merge_distance = self.merge_distance if self.remove_doubles else 0
+        return merge_by_distance(verts, edges, faces, face_sizes, merge_distance)
+
+    def build_lods(self, cache, wm, decimations):
+        """ Returns the mesh arrays for each of the `decimations` factors
+
+        Contours are read, filtered and their slopes computed only once, then
+        every level gets its own index and stitching.
+        """
+        print("\nDecimating contours")
+        wm.progress_begin(0, len(cache))
+        with PROFILE.stage('process_contours', len(cache)):
+            levels = self.decimate_layers(cache, decimations, wm)
+        wm.progress_end()
 
-        for f in faces: # add faces
-            if len(f) > 2:
-                bm.faces.new(tuple(bm.verts[c] for c in f))
+        results = []
+        for decimation, contours in zip(decimations, levels):
+            print('Generating Mesh data (decimation %d)'%decimation)
+            self.index_contours(contours)
+            wm.progress_begin(0, len(contours))
+            with PROFILE.stage('gen_mesh') as stage:
+                verts, edges, faces, face_sizes = self.gen_mesh(contours, wm)
+                stage.items = len(verts)
+            wm.progress_end()
+            if self.remove_doubles:
+                verts, edges, faces, face_sizes = merge_by_distance(verts, edges, faces, face_sizes, self.merge_distance)
+            results.append((verts, edges, faces, face_sizes))
+        return results
+
+
+def setup_stack(settings, path, size, layers=None, subrange=None):
+    """ Opens a stack of slices and sets up its geometry
+
+    `path` is a folder of images or a volume file, `size` the images size,
+    `layers` the number of slices (defaults to the number of slices found,
+    required for raw volumes) and `subrange` the first and last layers to use.
+    """
+    global LAYERS
+    global REF_SIZE
+    global RANGE
+    global PROFILE
+    stack = open_stack(path, (layers, size, size), settings.raw_dtype)
+    PROFILE = Profile(os.path.join(stack.cache_root, 'profile.json'))
+    REF_SIZE = size # Z dimmension will be adapted accordingly
+    LAYERS = layers or len(stack)
+    RANGE = list(subrange) if subrange else None
+    return stack
+
+def load_stack(settings, path, size, layers=None, subrange=None, wm=None, force=False, thresholds=None):
+    """ Sets up the stack (see `setup_stack`) and returns its up to date contours cache
+
+    When a list of `thresholds` is given, the slices are read once for all of
+    them and the list of their caches is returned.
+    """
+    stack = setup_stack(settings, path, size, layers, subrange)
+    params = (settings.contours_threshold, settings.load_step)
+    if thresholds is None:
+        return update_contour_cache(stack, params, wm or NullProgress(), RANGE, settings.workers, force)
+    return update_contour_caches(stack, thresholds, params, wm or NullProgress(), RANGE, settings.workers, force)
+
+def reconstruct(settings, path, size, layers=None, subrange=None, wm=None, force=False):
+    """ Runs the whole reconstruction of a stack of slices, returns the mesh arrays (see `SlicesPipeline`)
+
+    When `settings.lod_levels` lists decimation factors, a list of mesh arrays,
+    one for each level, is returned instead (using the contours engine).
+    The contours of the `settings.sweep_thresholds` levels are extracted in the
+    same pass as `contours_threshold`, with `sweep_meshes` a list of mesh arrays,
+    one for each of them, is returned instead (using the contours engines).
+    """
+    wm = wm or NullProgress()
+    if force:
+        STAGES.clear()
+    thresholds = parse_thresholds(settings.sweep_thresholds)
+    if thresholds and settings.sweep_meshes:
+        caches = load_stack(settings, path, size, layers, subrange, wm, force, thresholds)
+        return [settings.build_geometry(cache, wm) for cache in caches]
+    if settings.engine == 'VOLUME' and not parse_levels(settings.lod_levels):
+        return settings.volume_mesh(setup_stack(settings, path, size, layers, subrange), wm)
+    if thresholds: # cached for the next runs
+        thresholds = sorted(set(thresholds + [settings.contours_threshold]))
+        caches = load_stack(settings, path, size, layers, subrange, wm, force, thresholds)
+        cache = caches[thresholds.index(settings.contours_threshold)]
+    else:
+        cache = load_stack(settings, path, size, layers, subrange, wm, force)
+    if parse_levels(settings.lod_levels):
+        return settings.build_lods(cache, wm, parse_levels(settings.lod_levels))
+    return settings.build_geometry(cache, wm)
+
+
+def settings_error(settings):
+    " Returns why the text settings of `settings` can't be used, None if they are valid "
+    try:
+        parse_levels(settings.lod_levels)
+        parse_thresholds(settings.sweep_thresholds)
+    except ValueError as error:
+        return str(error)
+    return None
+
+def result_suffixes(settings):
+    " Name suffixes of the meshes returned by `reconstruct`, None when it returns a single one "
+    if parse_thresholds(settings.sweep_thresholds) and settings.sweep_meshes:
+        return ['_%g'%threshold for threshold in parse_thresholds(settings.sweep_thresholds)]
+    if parse_levels(settings.lod_levels):
+        return ['_LOD%d'%n for n in range(len(parse_levels(settings.lod_levels)))]
+    return None
+
+def save_profile(settings, path):
+    " Writes the stages profile of the last reconstruction next to its contours cache "
+    PROFILE.save(source=os.path.abspath(path),
+            settings=dict((name, getattr(settings, name)) for name in sorted(BatchSettings.DEFAULTS)))
+    print("Profile saved to %s"%PROFILE.filename)
+
+class NullProgress:
+    " Stands for the window manager progress functions when there is no UI "
+    def progress_begin(self, start, end):
+        pass
+
+    def progress_update(self, value):
+        pass
+
+    def progress_end(self):
+        pass
+
+class Cancelled(Exception):
+    pass
+
+class ThreadProgress:
+    """ Progress of a reconstruction running in a thread, polled by the UI
+
+    Setting `cancelled` stops the reconstruction at its next progress update.
+    """
+    def __init__(self):
+        self.start = 0
+        self.end = 1
+        self.value = 0
+        self.cancelled = False
+
+    def progress_begin(self, start, end):
+        self.start, self.end, self.value = start, end, start
+
+    def progress_update(self, value):
+        if self.cancelled:
+            raise Cancelled()
+        self.value = value
+
+    def progress_end(self):
+        self.value = self.end
+
+    def fraction(self):
+        return (self.value - self.start) / max(1, self.end - self.start)
+
+class ReconstructionThread(threading.Thread):
+    " Runs `reconstruct` in the background, its result (or error) is set once done "
+    def __init__(self, settings, *args, **kwargs):
+        threading.Thread.__init__(self, daemon=True)
+        self.settings = settings
+        self.args = args
+        self.kwargs = kwargs
+        self.progress = ThreadProgress()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = reconstruct(self.settings, *self.args, wm=self.progress, **self.kwargs)
+        except Cancelled:
+            print("\nCancelled")
+        except Exception:
+            self.error = traceback.format_exc()
+
+    @staticmethod
+    def running():
+        " Whether a reconstruction is still running (or being cancelled), they share the module state "
+        return any(isinstance(thread, ReconstructionThread) and thread.is_alive() for thread in threading.enumerate())
+
+
+def write_ply(filename, verts, faces, face_sizes):
+    " Writes a binary PLY file, edges which aren't part of a face are lost "
+    with open(filename, 'wb') as f:
+        f.write(('ply\nformat binary_little_endian 1.0\n'
+                'element vertex %d\nproperty float x\nproperty float y\nproperty float z\n'
+                'element face %d\nproperty list int int vertex_indices\nend_header\n'%(len(verts), len(face_sizes))).encode('ascii'))
+        f.write(verts.astype('<f4').tobytes())
+        # each face is its size followed by its vertex indices
+        records = np.empty(len(faces) + len(face_sizes), dtype='<i4')
+        starts = np.cumsum(face_sizes + 1) - face_sizes - 1
+        is_index = np.ones(len(records), dtype=bool)
+        is_index[starts] = False
+        records[starts] = face_sizes
+        records[is_index] = faces
+        f.write(records.tobytes())
+
+def write_obj(filename, verts, edges, faces, face_sizes):
+    with open(filename, 'w') as f:
+        np.savetxt(f, verts, fmt='v %.6f %.6f %.6f')
+        np.savetxt(f, edges + 1, fmt='l %d %d')
+        for face in np.split(faces + 1, np.cumsum(face_sizes)[:-1]) if len(face_sizes) else ():
+            f.write('f %s\n'%' '.join(map(str, face.tolist())))
+
+
+class BatchSettings(SlicesPipeline):
+    " Reconstruction settings outside of blender, defaults are the operator ones "
+    DEFAULTS = {
+            'decimation_factor': 2,
+            'max_tension': 20.0,
+            'simplification_factor': 0.0,
+            'scale': 1.0,
+            'contours_max': 100,
+            'contours_min_size': 200,
+            'contours_threshold': 0.01,
+            'load_step': 1,
+            'workers': 1,
+            'engine': 'CONTOURS',
+            'remove_doubles': True,
+            'merge_distance': 0.0001,
+            'write_profile': False,
+            'lod_levels': '',
+            'volume_chunk': 64,
+            'raw_dtype': '|u1',
+            'sweep_thresholds': '',
+            'sweep_meshes': True,
+            }
+
+    def __init__(self, **settings):
+        self.__dict__.update(self.DEFAULTS)
+        self.__dict__.update(settings)
+
+
+def batch_main(args):
+    """ Reconstructs a queue of slices folders
+
+    Use `blender --background --python mesh-reconstruction-from-slices.py -- [options] folders...`
+    or run this file with python (no .blend output then).
+    """
+    parser = argparse.ArgumentParser(description="Reconstructs meshes from folders of slices images or volume files")
+    parser.add_argument('folders', nargs='+', help="folders of images or .npy/.tif/raw volumes")
+    parser.add_argument('--output', help="output folder, defaults to the folder of each stack")
+    parser.add_argument('--format', choices=('ply', 'obj', 'blend'), default='ply')
+    parser.add_argument('--size', type=int, default=512, help="images size")
+    parser.add_argument('--layers', type=int, help="number of slices, defaults to the number of images")
+    parser.add_argument('--range', type=int, nargs=2, metavar=('START', 'END'), help="subrange of layers")
+    parser.add_argument('--reread', action='store_true', help="ignore the contours cache")
+    for name, default in sorted(BatchSettings.DEFAULTS.items()):
+        option = '--' + name.replace('_', '-')
+        if name == 'engine':
+            parser.add_argument(option, default=default, choices=('CONTOURS', 'STREAMING', 'PARALLEL', 'VOLUME'))
+        elif name == 'raw_dtype':
+            parser.add_argument(option, default=default, help="data type of raw volumes (numpy notation, eg: <u2)")
+        elif isinstance(default, bool) and default:
+            parser.add_argument('--no-' + name.replace('_', '-'), dest=name, action='store_false')
+        elif isinstance(default, bool):
+            parser.add_argument(option, action='store_true')
+        else:
+            parser.add_argument(option, type=type(default), default=default)
+    options = parser.parse_args(args)
+    if options.format == 'blend' and bpy is None:
+        parser.error("blend output requires running in blender")
+
+    settings = BatchSettings(**dict((name, getattr(options, name)) for name in BatchSettings.DEFAULTS))
+    if settings_error(settings):
+        parser.error(settings_error(settings))
+    failures = 0
+    for path in options.folders:
+        name = os.path.basename(os.path.normpath(path))
+        folder = path
+        if os.path.isfile(path): # volume file
+            name = os.path.splitext(name)[0]
+            folder = os.path.dirname(os.path.abspath(path))
+        filename = os.path.join(options.output or folder, '%s.%s'%(name, options.format))
+        print("Reconstructing %s -> %s"%(path, filename))
+        t = time.time()
+        try:
+            result = reconstruct(settings, path, options.size, options.layers, options.range, force=options.reread)
+            suffixes = result_suffixes(settings)
+            if suffixes:
+                base, extension = os.path.splitext(filename)
+                outputs = [(base + suffix.lower() + extension, name + suffix, arrays)
+                        for suffix, arrays in zip(suffixes, result)]
+            else:
+                outputs = [(filename, name, result)]
+            for filename, obj_name, (verts, edges, faces, face_sizes) in outputs:
+                if options.format == 'ply':
+                    write_ply(filename, verts, faces, face_sizes)
+                elif options.format == 'obj':
+                    write_obj(filename, verts, edges, faces, face_sizes)
+                else:
+                    save_blend(filename, obj_name, verts, edges, faces, face_sizes)
+                print("%s: %d vertices, %d faces"%(obj_name, len(verts), len(face_sizes)))
+            print(PROFILE.table())
+            if settings.write_profile:
+                save_profile(settings, path)
+        except Exception:
+            traceback.print_exc()
+            failures += 1
+        else:
+            print("%s done in %.1fs"%(name, time.time() - t))
+    return 1 if failures else 0
 
-        # make the bmesh the object's mesh
-        bm.to_mesh(mesh)
-        bm.free()  # always do this when finished
 
-        if self.remove_doubles:
-            bpy.ops.object.editmode_toggle()
-            bpy.ops.mesh.select_all(action='TOGGLE')
-            bpy.ops.mesh.remove_doubles()
-            bpy.ops.object.editmode_toggle()
-
-        return {'FINISHED'}
-
-class VIEW3D_PT_tools_Meshify(Panel):
-    bl_category = "Tools"
-    bl_context = "objectmode"
-    bl_label = "Meshify slices"
-    bl_idname = "OBJECT_OT_slicify"
-    bl_space_type = 'VIEW_3D'
-    bl_region_type = 'TOOLS'
-
-    def draw(self, context):
-        layout = self.layout
-        obj = context.object
-        if obj:
-            col = layout.column(align=True)
-            col.prop(obj, "source_slices", expand=True, text="")
-            col.prop(obj, "source_slices_size", expand=True, text="Images size")
-            col.prop(obj, "source_slices_nr", expand=True, text="Number of images")
-
-            col.prop(obj, "partial_slices", expand=True, text="Render subrange")
-            scol = col.row(align=True)
-            scol.active = obj.partial_slices
-            scol.prop(obj, "partial_slices_start",expand=True, text="Start")
-            scol.prop(obj, "partial_slices_end", expand=True, text="End")
-
-            col = layout.column(align=True)
-            col.operator("object.meslicify", emboss=True)
-
-def register():
-    bpy.utils.register_class(SimpleOperator)
-    bpy.utils.register_class(VIEW3D_PT_tools_Meshify)
-
-def unregister():
-    bpy.utils.unregister_class(VIEW3D_PT_tools_Meshify)
-    bpy.utils.unregister_class(SimpleOperator)
+if bpy is not None:
+    def new_mesh_object(name, verts, edges, faces, face_sizes):
+        mesh = bpy.data.meshes.new("Made from slices")
+        fill_mesh(mesh, verts, edges, faces, face_sizes)
+        return bpy.data.objects.new(name, mesh)
+
+    def save_blend(filename, name, verts, edges, faces, face_sizes):
+        " Saves the mesh alone in a .blend file "
+        bpy.ops.wm.read_homefile(use_empty=True)
+        bpy.context.scene.objects.link(new_mesh_object(name, verts, edges, faces, face_sizes))
+        bpy.ops.wm.save_as_mainfile(filepath=os.path.abspath(filename))
+
+
+    class SimpleOperator(SlicesPipeline, bpy.types.Operator):
+        bl_idname = "object.meslicify"
+        bl_label = "Import slices"
+        bl_options = {'REGISTER','UNDO'}
+
+        decimation_factor = bpy.props.IntProperty(name="Decimation factor", default=2, min=1, max=100)
+        face_tolerance = bpy.props.IntProperty(name="Face tolerance", default=50, min=1, max=1000)
+        max_tension = bpy.props.FloatProperty(name="Max tension", default=20.0, min=0.01, max=1000)
+        simplification_factor = bpy.props.FloatProperty(name="Simplify", default=0, min=0, max=2)
+        scale = bpy.props.FloatProperty(name="Scale", default=1, min=0.01, max=10)
+
+        contours_max = bpy.props.IntProperty(name="Feat. detection: max / slice", default=100, min=1, max=500)
+        contours_min_size = bpy.props.IntProperty(name="Feat. detection minimum size", default=200, min=3, max=20000)
+        contours_threshold = bpy.props.FloatProperty(name="Threshold", default=0.01, min=0, max=1)
+        load_step = bpy.props.IntProperty(name="Load downsampling", default=1, min=1, max=16)
+        workers = bpy.props.IntProperty(name="Workers", default=1, min=1, max=64)
+
+        engine = bpy.props.EnumProperty(name="Engine", default='CONTOURS', items=(
+            ('CONTOURS', "Contours", "Index every layer, then stitch them"),
+            ('STREAMING', "Streaming", "Index and stitch layers one after the other, keeping only two in memory"),
+            ('PARALLEL', "Parallel", "Stitch the pairs of layers in worker processes"),
+            ('VOLUME', "Volume", "Extract the isosurface of the slices volume (marching cubes)"),
+            ))
+        volume_chunk = bpy.props.IntProperty(name="Volume chunk (slices)", default=64, min=2, max=1024)
+        raw_dtype = bpy.props.EnumProperty(name="Raw volume data", default='|u1', items=(
+            ('|u1', "8 bits", "Unsigned 8 bits"),
+            ('<u2', "16 bits", "Unsigned 16 bits, little endian"),
+            ('>u2', "16 bits (big endian)", "Unsigned 16 bits, big endian"),
+            ('<i2', "16 bits signed", "Signed 16 bits, little endian"),
+            ('<f4', "32 bits float", "Float 32 bits, little endian"),
+            ))
+
+        remove_doubles = bpy.props.BoolProperty(name="Remove doubles", default=True)
+        merge_distance = bpy.props.FloatProperty(name="Merge distance", default=0.0001, min=0, max=1, precision=5)
+        lod_levels = bpy.props.StringProperty(name="LOD decimations", default="",
+                description="Comma separated decimation factors, builds one object per level (eg: 8,4,1)")
+        sweep_thresholds = bpy.props.StringProperty(name="Threshold sweep", default="",
+                description="Comma separated thresholds whose contours are extracted in the same pass (eg: 0.1,0.2,0.4)")
+        sweep_meshes = bpy.props.BoolProperty(name="Sweep meshes", default=True,
+                description="Build one object per sweep threshold, else only cache their contours")
+        write_profile = bpy.props.BoolProperty(name="Write profile", default=False,
+                description="Save the time and memory used by each stage in profile.json next to the contours cache")
+
+        def execute(self, context):
+            if ReconstructionThread.running():
+                self.report({'WARNING'}, "A slices import is still running or being cancelled")
+                return {'CANCELLED'}
+            if settings_error(self):
+                self.report({'ERROR'}, settings_error(self))
+                return {'CANCELLED'}
+            obj = context.selected_objects[0]
+            print("Reloading state...")
+            PATH = obj.source_slices # os.path.dirname(context.scene.render.filepath)
+            subrange = [obj.partial_slices_start, obj.partial_slices_end] if obj.partial_slices else None
+            wm = bpy.context.window_manager # notify progress
+
+            result = reconstruct(self, PATH, obj.source_slices_size, obj.source_slices_nr,
+                    subrange, wm, 'REREAD' in os.environ)
+            self.link_result(context, result, PATH)
+            return {'FINISHED'}
+
+        def invoke(self, context, event):
+            """ Runs the reconstruction in a background thread, the mesh is added when it's done
+
+            Esc cancels it, redoing the operator runs `execute`.
+            """
+            if ReconstructionThread.running():
+                self.report({'WARNING'}, "A slices import is still running or being cancelled")
+                return {'CANCELLED'}
+            if settings_error(self):
+                self.report({'ERROR'}, settings_error(self))
+                return {'CANCELLED'}
+            obj = context.selected_objects[0]
+            subrange = [obj.partial_slices_start, obj.partial_slices_end] if obj.partial_slices else None
+            # the thread can't read the operator properties
+            settings = BatchSettings(**dict((name, getattr(self, name)) for name in BatchSettings.DEFAULTS))
+            self._path = obj.source_slices
+            self._thread = ReconstructionThread(settings, obj.source_slices, obj.source_slices_size,
+                    obj.source_slices_nr, subrange, force='REREAD' in os.environ)
+            self._thread.start()
+
+            wm = context.window_manager
+            wm.progress_begin(0, 100)
+            self._timer = wm.event_timer_add(0.1, context.window)
+            wm.modal_handler_add(self)
+            return {'RUNNING_MODAL'}
+
+        def modal(self, context, event):
+            thread = self._thread
+            if event.type == 'ESC' and event.value == 'PRESS':
+                thread.progress.cancelled = True
+                self.stop_modal(context)
+                self.report({'WARNING'}, "Slices import cancelled")
+                return {'CANCELLED'}
+            if event.type != 'TIMER':
+                return {'PASS_THROUGH'}
+
+            if thread.is_alive():
+                fraction = thread.progress.fraction()
+                context.window_manager.progress_update(int(100 * fraction))
+                if context.area:
+                    context.area.header_text_set("Import slices: %s %d%% (Esc to cancel)"%(
+                            PROFILE.current or "starting", 100 * fraction))
+                return {'PASS_THROUGH'}
+
+            self.stop_modal(context)
+            if thread.error is not None:
+                print(thread.error)
+                self.report({'ERROR'}, thread.error.strip().splitlines()[-1])
+                return {'CANCELLED'}
+            self.link_result(context, thread.result, self._path)
+            return {'FINISHED'}
+
+        def stop_modal(self, context):
+            wm = context.window_manager
+            wm.event_timer_remove(self._timer)
+            wm.progress_end()
+            if context.area:
+                context.area.header_text_set()
+
+        def link_result(self, context, result, path):
+            " Adds the reconstructed mesh (or LOD objects) to the scene "
+            scene = context.scene
+            suffixes = result_suffixes(self)
+            if suffixes: # LODs finest first or threshold levels, grouped
+                group = bpy.data.groups.new("FromSlices LODs" if suffixes[0] == "_LOD0" else "FromSlices levels")
+                objects = [new_mesh_object("FromSlices" + suffix, *arrays) for suffix, arrays in zip(suffixes, result)]
+                for n, new_obj in enumerate(objects):
+                    scene.objects.link(new_obj)
+                    group.objects.link(new_obj)
+                    new_obj.hide = n > 0
+            else:
+                new_obj = new_mesh_object("FromSlices", *result)
+                scene.objects.link(new_obj)  # put the object into the scene (link)
+                objects = [new_obj]
+
+            scene.objects.active = objects[0]  # set as the active object in the scene
+            objects[0].select = True  # select object
+
+            print(PROFILE.table())
+            if self.write_profile:
+                save_profile(self, path)
+            self.report({'INFO'}, PROFILE.summary())
+
+    class VIEW3D_PT_tools_Meshify(Panel):
+        bl_category = "Tools"
+        bl_context = "objectmode"
+        bl_label = "Meshify slices"
+        bl_idname = "OBJECT_OT_slicify"
+        bl_space_type = 'VIEW_3D'
+        bl_region_type = 'TOOLS'
+
+        def draw(self, context):
+            layout = self.layout
+            obj = context.object
+            if obj:
+                col = layout.column(align=True)
+                col.prop(obj, "source_slices", expand=True, text="")
+                col.prop(obj, "source_slices_size", expand=True, text="Images size")
+                col.prop(obj, "source_slices_nr", expand=True, text="Number of images")
+
+                col.prop(obj, "partial_slices", expand=True, text="Render subrange")
+                scol = col.row(align=True)
+                scol.active = obj.partial_slices
+                scol.prop(obj, "partial_slices_start",expand=True, text="Start")
+                scol.prop(obj, "partial_slices_end", expand=True, text="End")
+
+                col = layout.column(align=True)
+                col.operator("object.meslicify", emboss=True)
+
+    def register():
+        bpy.utils.register_class(SimpleOperator)
+        bpy.utils.register_class(VIEW3D_PT_tools_Meshify)
+
+    def unregister():
+        bpy.utils.unregister_class(VIEW3D_PT_tools_Meshify)
+        bpy.utils.unregister_class(SimpleOperator)
 
 if __name__ == "__main__":
+    if bpy is None or '--' in sys.argv: # batch mode
+        sys.exit(batch_main(sys.argv[sys.argv.index('--')+1:] if '--' in sys.argv else sys.argv[1:]))
 
     bpy.types.Object.source_slices =  bpy.props.StringProperty(default="/tmp/", subtype="DIR_PATH")
     bpy.types.Object.source_slices_size = bpy.props.IntProperty(default=512, min=16, max=1024)